@@ -0,0 +1,34 @@
+#!/bin/bash
+# Check myscheduler-fleet against a throwaway daemon on localhost.
+# Requires deluge to be installed, run from the repository root.
+set -e -o pipefail
+
+PORT=${PORT:-58899}
+CONFIG=$(mktemp -d)
+trap 'kill $DAEMON_PID 2>/dev/null; rm -fr "$CONFIG"' EXIT
+
+# Install the plugin and enable it in the daemon config
+mkdir -p "$CONFIG/plugins"
+python setup.py -q bdist_egg -d "$CONFIG/plugins" > /dev/null
+echo '{"file": 1, "format": 1}{"enabled_plugins": ["MyScheduler"]}' > "$CONFIG/core.conf"
+
+deluged -d -c "$CONFIG" -p "$PORT" -L error &
+DAEMON_PID=$!
+
+fleet() {
+    python -m deluge_myscheduler.fleet -c "$CONFIG" "$@" "$SCHEDULE" "127.0.0.1:$PORT"
+}
+
+SCHEDULE="$CONFIG/schedule.json"
+python -c "import json; print(json.dumps({'low_down': 123.0, 'button_state': [[1] * 7] * 24}))" > "$SCHEDULE"
+
+# Wait for the daemon and the plugin to come up
+for i in $(seq 30); do
+    fleet -n > /dev/null 2>&1 && break
+    sleep 1
+done
+
+fleet -n | tee /dev/stderr | grep -q 'would set button_state,low_down'
+fleet | tee /dev/stderr | grep -q 'Yellow	set button_state,low_down'
+fleet | tee /dev/stderr | grep -q 'Yellow	unchanged'
+echo 'Fleet check passed'
@@ -13,10 +13,18 @@
 
 from __future__ import unicode_literals
 
+import datetime
+import itertools
 import logging
 import time
+from collections import deque
 
-from twisted.internet import reactor
+from twisted.internet import reactor, task
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 import deluge.component as component
 import deluge.configmanager
@@ -24,6 +32,9 @@ from deluge.core.rpcserver import export
 from deluge.event import DelugeEvent, SessionResumedEvent
 from deluge.plugins.pluginbase import CorePluginBase
 
+from .ranking import RANK_KEYS, TorrentRanking
+from .storage import ConfigWriter
+
 log = logging.getLogger(__name__)
 
 DEFAULT_PREFS = {
@@ -35,13 +46,100 @@ DEFAULT_PREFS = {
     'button_state': [[0] * 7 for dummy in range(24)],
     'ignore_schedule': False,
     'force_use_individual': True,
-    'force_unforce_finished': True
+    'force_unforce_finished': True,
+    'quota_enabled': False,
+    'quota_limit': 0.0,
+    'quota_yellow': 80,
+    'quota_red': 100,
+    'quota_reset_day': 1,
+    'adaptive_enabled': False,
+    'adaptive_share': 80,
+    'adaptive_link_down': -1.0,
+    'adaptive_link_up': -1.0,
+    'adaptive_min_down': 10.0,
+    'adaptive_min_up': 10.0,
+    'adaptive_max_down': -1.0,
+    'adaptive_max_up': -1.0,
+    'adaptive_interface': '',
+    'profiles': [],
+    'red_keep_running': 0,
+    'red_rank_key': 'ratio_deficit',
+    'yellow_exempt_forced': False,
 }
 
 DEFAULT_STATES = {}
 
+DEFAULT_HISTORY = {'transitions': []}
+
+DEFAULT_QUOTA = {'period': '', 'bytes': 0}
+
+# Seconds between two samples of the session transfer counters
+QUOTA_INTERVAL = 300
+
+# Session (received, sent) byte counters
+SESSION_COUNTERS = ['net.recv_bytes', 'net.sent_bytes']
+
+# Seconds between two adjustments of the adaptive Yellow limits
+ADAPTIVE_INTERVAL = 30
+
+# Weight of the newest throughput sample in the smoothed rate
+ADAPTIVE_SMOOTHING = 0.3
+
+# Fraction of the rate error corrected per adjustment
+ADAPTIVE_GAIN = 0.5
+
+# Limit changes smaller than this fraction are not pushed to the session
+ADAPTIVE_DEADBAND = 0.05
+
+# Seconds between two incremental compaction passes of the torrent states
+COMPACT_INTERVAL = 600
+
+# Maximum number of torrent states checked per compaction pass
+COMPACT_BATCH = 1000
+
+# Seconds between two incremental rescoring passes of the ranked torrents
+RANK_INTERVAL = 60
+
+# Maximum number of torrents rescored per pass
+RANK_BATCH = 500
+
+# Seconds between two checks of the per torrent share in Yellow
+SHARE_INTERVAL = 30
+
+# Share changes smaller than this fraction don't re-throttle the torrents
+SHARE_DEADBAND = 0.1
+
+# Lowest per torrent share in KiB/s, libtorrent takes a 0 B/s limit as unlimited
+MIN_SHARE = 1 / 1024.0
+
+# Prefs that change the torrents kept running in Red
+RANKING_SETTINGS = ['red_keep_running', 'red_rank_key']
+
+# Prefs that change the quota level
+QUOTA_SETTINGS = ['quota_enabled', 'quota_limit', 'quota_yellow', 'quota_red', 'quota_reset_day']
+
+# Version header of the plugin config files, as written by deluge.config.Config
+CONFIG_VERSION = {'format': 1, 'file': 1}
+
+# Maximum number of schedule transitions kept in the history
+HISTORY_SIZE = 1000
+
 STATES = {0: 'Green', 1: 'Yellow', 2: 'Red'}
 
+LEVELS = {v: k for k, v in STATES.items()}
+
+# Colours of the built-in levels
+STATE_COLOURS = {0: '#73D216', 1: '#EDD400', 2: '#CC0000'}
+
+# Prefs that only affect the Yellow session settings
+SLOW_SETTINGS = [
+    'low_down',
+    'low_up',
+    'low_active',
+    'low_active_down',
+    'low_active_up',
+]
+
 CONTROLLED_SETTINGS = [
     'max_download_speed',
     'max_upload_speed',
@@ -50,6 +148,103 @@ CONTROLLED_SETTINGS = [
     'max_active_seeding',
 ]
 
+# Libtorrent session settings for the controlled core settings
+SESSION_SETTINGS = {
+    'max_download_speed': 'download_rate_limit',
+    'max_upload_speed': 'upload_rate_limit',
+    'max_active_limit': 'active_limit',
+    'max_active_downloading': 'active_downloads',
+    'max_active_seeding': 'active_seeds',
+}
+
+# Controlled settings in KiB/s
+RATE_SETTINGS = ['max_download_speed', 'max_upload_speed']
+
+
+def compile_schedule(button_state, levels=len(STATES)):
+    """
+    Validate a 24x7 button_state and compile it into a flat level table.
+
+    :param button_state: list, 24 rows (hours) of 7 levels (days)
+    :param levels: int, the number of levels in the palette
+    :return: bytearray, 168 levels indexed by hour * 7 + day
+    :raises ValueError: if the button_state is malformed
+    """
+    if len(button_state) != 24:
+        raise ValueError('Schedule must have 24 hours, got %s' % len(button_state))
+
+    table = bytearray(24 * 7)
+    for hour, days in enumerate(button_state):
+        if len(days) != 7:
+            raise ValueError('Schedule hour %s must have 7 days' % hour)
+        for day, level in enumerate(days):
+            if level not in range(levels):
+                raise ValueError(
+                    'Invalid schedule level %r for hour %s, day %s' % (level, hour, day)
+                )
+            table[hour * 7 + day] = int(level)
+    return table
+
+
+def validate_profiles(profiles):
+    """
+    Validate the named limit profiles appended to the built-in levels.
+
+    Each profile is a dict with a 'name', an optional 'colour' and any of the
+    CONTROLLED_SETTINGS; settings left out use the core config value.
+
+    :param profiles: list of dicts
+    :raises ValueError: if a profile is malformed
+    """
+    if len(STATES) + len(profiles) > 256:
+        raise ValueError('Too many profiles: %s' % len(profiles))
+
+    for profile in profiles:
+        if not profile.get('name'):
+            raise ValueError('Profile %r has no name' % profile)
+        for key, value in profile.items():
+            if key in ('name', 'colour'):
+                continue
+            if key not in CONTROLLED_SETTINGS:
+                raise ValueError('Invalid setting %r in profile %s' % (key, profile['name']))
+            if not isinstance(value, (int, float)):
+                raise ValueError(
+                    'Invalid value %r for %s in profile %s' % (value, key, profile['name'])
+                )
+
+
+def get_link_counters(interface=''):
+    """
+    Returns the host's (received, sent) byte counters of its network interfaces.
+
+    Read from /proc/net/dev, or with psutil when installed on other platforms.
+
+    :param interface: str, the interface to count, all but loopback when empty
+    :return: list, the two counters, or None if they can't be read
+    """
+    try:
+        counters = {}
+        with open('/proc/net/dev') as _file:
+            # Skip the two header lines
+            for line in list(_file)[2:]:
+                name, _, fields = line.partition(':')
+                fields = fields.split()
+                counters[name.strip()] = (int(fields[0]), int(fields[8]))
+    except (IOError, OSError, IndexError, ValueError):
+        if psutil is None:
+            return None
+        counters = {
+            name: (nic.bytes_recv, nic.bytes_sent)
+            for name, nic in psutil.net_io_counters(pernic=True).items()
+        }
+
+    if interface:
+        if interface not in counters:
+            return None
+        return list(counters[interface])
+    links = [nic for name, nic in counters.items() if not name.startswith('lo')]
+    return [sum(nic[0] for nic in links), sum(nic[1] for nic in links)]
+
 
 class SchedulerEvent(DelugeEvent):
     """
@@ -63,6 +258,18 @@ class SchedulerEvent(DelugeEvent):
         self._args = [colour]
 
 
+class SchedulerProfileEvent(DelugeEvent):
+    """
+    Emitted when the active schedule profile changes.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: str, the name of the current profile
+        """
+        self._args = [name]
+
+
 class Core(CorePluginBase):
     def enable(self):
         # Create the defaults with the core config
@@ -76,14 +283,48 @@ class Core(CorePluginBase):
         self.config = deluge.configmanager.ConfigManager(
             'myscheduler.conf', DEFAULT_PREFS
         )
+        self.config_writer = ConfigWriter(self.config, CONFIG_VERSION)
 
         self.torrent_states = deluge.configmanager.ConfigManager(
             'myschedulerstates.conf', DEFAULT_STATES
         )
+        self.states_writer = ConfigWriter(self.torrent_states, CONFIG_VERSION)
+
+        self.schedule = compile_schedule(
+            self.config['button_state'], len(STATES) + len(self.config['profiles'])
+        )
+        self.schedule_version = 1
+
+        # Session settings last pushed for a profile
+        self._applied_settings = {}
+        # The (level, session settings) of the last applied profile
+        self._applied_profile = None
+        # Per torrent (download, upload) limits of non-forced torrents in Yellow
+        self._torrent_share = None
+
+        # Transitions are stored as compact [time, from, to, torrents, duration] lists
+        self.history_config = deluge.configmanager.ConfigManager(
+            'myschedulerhistory.conf', DEFAULT_HISTORY
+        )
+        self.history_writer = ConfigWriter(self.history_config, CONFIG_VERSION)
+        self.history = deque(
+            self.history_config['transitions'], maxlen=HISTORY_SIZE
+        )
+
+        # Transferred bytes in the current billing period
+        self.quota = deluge.configmanager.ConfigManager(
+            'myschedulerquota.conf', DEFAULT_QUOTA
+        )
+        self.quota_writer = ConfigWriter(self.quota, CONFIG_VERSION)
+        self.quota_level = self._get_quota_level()
+        self._quota_last = None
+        self._adaptive = None
 
         self._cleanup_states()
+        self._reset_ranking()
 
-        self.state = self.get_state()
+        self.level = self.get_level()
+        self.state = self._get_level_state(self.level)
 
         # Apply the scheduling rules
         self.do_schedule(False)
@@ -94,6 +335,24 @@ class Core(CorePluginBase):
         log.debug('Next schedule check in %s seconds' % secs_to_next_hour)
         self.timer = reactor.callLater(secs_to_next_hour, self.do_schedule)
 
+        self.quota_timer = task.LoopingCall(self._sample_quota)
+        self.quota_timer.start(QUOTA_INTERVAL)
+
+        self.adaptive_timer = task.LoopingCall(self._adapt_slow_settings)
+        self.adaptive_timer.start(ADAPTIVE_INTERVAL)
+
+        self.compact_report = {'time': None, 'scanned': 0, 'reclaimed': 0}
+        self._compact_sweep = None
+        self.compact_timer = task.LoopingCall(self._compact_states)
+        self.compact_timer.start(COMPACT_INTERVAL, now=False)
+
+        self._rank_sweep = None
+        self.rank_timer = task.LoopingCall(self._rescore_torrents)
+        self.rank_timer.start(RANK_INTERVAL, now=False)
+
+        self.share_timer = task.LoopingCall(self._refresh_torrent_share)
+        self.share_timer.start(SHARE_INTERVAL, now=False)
+
         # Register torrent state change events
         component.get('EventManager').register_event_handler(
             'TorrentAddedEvent', self._on_torrent_added
@@ -116,6 +375,16 @@ class Core(CorePluginBase):
     def disable(self):
         if self.timer.active():
             self.timer.cancel()
+        if self.quota_timer.running:
+            self.quota_timer.stop()
+        if self.adaptive_timer.running:
+            self.adaptive_timer.stop()
+        if self.compact_timer.running:
+            self.compact_timer.stop()
+        if self.rank_timer.running:
+            self.rank_timer.stop()
+        if self.share_timer.running:
+            self.share_timer.stop()
 
         # Deregister torrent state change events
         component.get('EventManager').deregister_event_handler(
@@ -135,13 +404,25 @@ class Core(CorePluginBase):
             'ConfigValueChangedEvent', self.on_config_value_changed
         )
 
+        self._restore_torrent_limits()
         self.__apply_set_functions()
 
+        # Don't lose snapshots queued behind a write in flight
+        for writer in [
+            self.config_writer,
+            self.states_writer,
+            self.history_writer,
+            self.quota_writer,
+        ]:
+            writer.flush()
+
     def update(self):
         pass
 
     def on_config_value_changed(self, key, value):
         if key in CONTROLLED_SETTINGS:
+            # The core has pushed its own value for this setting
+            self._applied_settings.pop(SESSION_SETTINGS[key], None)
             self.do_schedule(False)
 
     def __apply_set_functions(self):
@@ -153,81 +434,508 @@ class Core(CorePluginBase):
             component.get('PreferencesManager').do_config_set_func(
                 setting, core_config[setting]
             )
+        self._applied_settings = {}
+        self._applied_profile = None
         # Resume the session if necessary
         # component.get('Core').resume_session()
-        self._resume_all_torrents()
+        return self._resume_all_torrents()
 
     def do_schedule(self, timer=True):
         """
         This is where we apply schedule rules.
         """
 
-        state = self.get_state()
-        self._update_torrents()
+        start = time.time()
+        touched = 0
+        level = self.get_level()
+        state = self._get_level_state(level)
+        if not (
+            (state == 'Yellow' and self._exempt_forced())
+            or (state == 'Red' and self._use_ranking())
+        ):
+            # Otherwise the torrents are updated once the state is set below,
+            # the ranking only touching the ones whose membership changed
+            self._update_torrents()
 
         if state == 'Green':
             # This is Green (Normal) so we just make sure we've applied the
             # global defaults
-            self.__apply_set_functions()
+            touched = self.__apply_set_functions()
         elif state == 'Yellow':
-            # This is Yellow (Slow), so use the settings provided from the user
-            settings = {
-                'active_limit': self.config['low_active'],
-                'active_downloads': self.config['low_active_down'],
-                'active_seeds': self.config['low_active_up'],
-                'download_rate_limit': int(self.config['low_down'] * 1024),
-                'upload_rate_limit': int(self.config['low_up'] * 1024),
-            }
-            component.get('Core').apply_session_settings(settings)
+            # This is Yellow (Slow), so use the settings of the user's profile
+            self._apply_profile_settings(level)
             # Resume the session if necessary
             # component.get('Core').resume_session()
-            self._resume_all_torrents()
+            touched = self._resume_all_torrents()
         elif state == 'Red':
-            # This is Red (Stop), so pause the libtorrent session
-            # component.get('Core').pause_session()
-            self._pause_all_torrents()
-
+            # Leaving Yellow, so the profile is applied again afterwards
+            self._applied_profile = None
+            if not self._use_ranking():
+                # This is Red (Stop), so pause the libtorrent session
+                # component.get('Core').pause_session()
+                touched = self._pause_all_torrents()
+
+        previous_state = self.state
+        previous_level = self.level
         if state != self.state:
             # The state has changed since last update so we need to emit an event
             self.state = state
             component.get('EventManager').emit(SchedulerEvent(self.state))
+        if level != self.level:
+            self.level = level
+            component.get('EventManager').emit(
+                SchedulerProfileEvent(self._get_profile(level)['name'])
+            )
 
         # Called after self.state is set
-        if self.config['force_use_individual'] and (state == 'Green' or state == 'Red'):
+        if state == 'Red' and self._use_ranking():
+            # Keep the best torrents running, only touching changed ones
+            touched = self._apply_ranking(previous_state != 'Red')
+        elif self.config['force_use_individual'] and (
+            state == 'Green' or state == 'Red' or self._exempt_forced()
+        ):
             self._update_torrents()
 
+        if level != previous_level:
+            self._record_transition(
+                previous_level, level, touched, time.time() - start
+            )
+
         if timer:
             # Call this again in 1 hour
             log.debug('Next schedule check in 3600 seconds')
             self.timer = reactor.callLater(3600, self.do_schedule)
 
+    def _get_profile_settings(self, level):
+        """
+        Returns the controlled settings of a Yellow level, in core config units.
+        """
+        profile = self._get_profile(level)
+        core_config = component.get('Core').config
+        return {
+            setting: profile.get(setting, core_config[setting])
+            for setting in CONTROLLED_SETTINGS
+        }
+
+    def _apply_profile_settings(self, level):
+        """
+        Apply the session settings of a Yellow level.
+
+        Only the settings that differ from the ones already applied are pushed.
+        When the level and its settings are unchanged, the adapted rates are
+        kept and only settings overridden by the core are pushed again.
+        """
+        profile_settings = self._get_profile_settings(level)
+        if self._exempt_forced():
+            # Forced torrents keep full speed, the others get a per torrent
+            # share of the profile rates
+            self._torrent_share = self._get_torrent_share(profile_settings)
+            core_config = component.get('Core').config
+            for setting in RATE_SETTINGS:
+                profile_settings[setting] = core_config[setting]
+
+        target = {}
+        for setting, value in profile_settings.items():
+            if setting in RATE_SETTINGS:
+                # We need to convert KiB/s to B/s
+                value = -1 if value < 0 else int(value * 1024)
+            target[SESSION_SETTINGS[setting]] = value
+
+        if (level, target) == self._applied_profile:
+            settings = {
+                session_setting: value
+                for session_setting, value in target.items()
+                if session_setting not in self._applied_settings
+            }
+            if self._adaptive is not None:
+                # Restore the adapted rates rather than the profile rates
+                for i, setting in enumerate(RATE_SETTINGS):
+                    session_setting = SESSION_SETTINGS[setting]
+                    if session_setting in settings and self._adaptive['limits'][i] > 0:
+                        settings[session_setting] = int(self._adaptive['limits'][i] * 1024)
+        else:
+            settings = {
+                session_setting: value
+                for session_setting, value in target.items()
+                if self._applied_settings.get(session_setting) != value
+            }
+            self._applied_profile = (level, target)
+            # Restart the adaptive controller from the profile limits
+            self._adaptive = None
+
+        if settings:
+            log.debug('Applying profile settings: %s', settings)
+            component.get('Core').apply_session_settings(settings)
+            self._applied_settings.update(settings)
+
+    def _exempt_forced(self):
+        return self.config['yellow_exempt_forced'] and self.config['force_use_individual']
+
+    def _get_torrent_share(self, settings):
+        """
+        Returns the (download, upload) limits of a non-forced torrent in Yellow.
+
+        The profile rates are divided over the non-forced torrents currently
+        transferring in each direction, idle seeds don't take a share. Torrents
+        becoming active exceed the profile rates until the next refresh.
+        """
+        downloading = uploading = 0
+        for torrent_id, torrent in component.get('Core').torrentmanager.torrents.items():
+            if self.torrent_states.config.get(torrent_id, {}).get('forced'):
+                continue
+            if torrent.status.download_payload_rate > 0:
+                downloading += 1
+            if torrent.status.upload_payload_rate > 0:
+                uploading += 1
+
+        share = []
+        for rate, count in [
+            ('max_download_speed', downloading),
+            ('max_upload_speed', uploading),
+        ]:
+            if settings[rate] <= 0:
+                # The session rate is unlimited
+                share.append(-1)
+            else:
+                share.append(max(settings[rate] / float(max(count, 1)), MIN_SHARE))
+        return share
+
+    def _refresh_torrent_share(self):
+        """
+        Throttle the torrents to a new share when the number of transferring
+        non-forced torrents changed it by more than the deadband.
+        """
+        if self.state != 'Yellow' or not self._exempt_forced():
+            return
+
+        share = self._get_torrent_share(self._get_profile_settings(self.level))
+        if self._torrent_share is not None and all(
+            new == old or (new > 0 and old > 0 and abs(new - old) <= SHARE_DEADBAND * old)
+            for new, old in zip(share, self._torrent_share)
+        ):
+            return
+        self._torrent_share = share
+        self._update_torrents()
+
+    def _set_torrent_limits(self, torrent, tstate):
+        """
+        Throttle a non-forced torrent to its share in Yellow, restore its own
+        limits otherwise. Torrents already in the right state are left alone.
+        """
+        if (
+            self.state == 'Yellow'
+            and self._exempt_forced()
+            and not tstate['forced']
+            and self._torrent_share is not None
+        ):
+            if 'limits' not in tstate:
+                tstate['limits'] = [
+                    torrent.options['max_download_speed'],
+                    torrent.options['max_upload_speed'],
+                ]
+            down, up = self._torrent_share
+        elif 'limits' in tstate:
+            down, up = tstate.pop('limits')
+        else:
+            return
+
+        if torrent.options['max_download_speed'] != down:
+            torrent.set_max_download_speed(down)
+        if torrent.options['max_upload_speed'] != up:
+            torrent.set_max_upload_speed(up)
+
+    def _restore_torrent_limits(self):
+        """
+        Restore the own limits of all torrents throttled in Yellow.
+        """
+        torrents = component.get('Core').torrentmanager.torrents
+        restored = False
+        for torrent_id, tstate in self.torrent_states.config.items():
+            if 'limits' not in tstate:
+                continue
+            down, up = tstate.pop('limits')
+            restored = True
+            if torrent_id in torrents:
+                torrents[torrent_id].set_max_download_speed(down)
+                torrents[torrent_id].set_max_upload_speed(up)
+        if restored:
+            self.states_writer.save()
+
+    def _adapt_slow_settings(self):
+        """
+        Steer the Yellow rate limits towards the target share of the link.
+
+        The other traffic of the host is the interface throughput minus the
+        session throughput, the limits are steered towards the target share
+        left over by it. The rates are smoothed and only a fraction of the
+        error is corrected per interval, so the limits settle instead of
+        oscillating. At most one settings push is made per call.
+        """
+        # Exempting forced torrents leaves the session rates unthrottled
+        if (
+            not self.config['adaptive_enabled']
+            or self.state != 'Yellow'
+            or self._exempt_forced()
+        ):
+            self._adaptive = None
+            return
+
+        now = time.time()
+        counters = self._get_session_counters()
+        link_counters = get_link_counters(self.config['adaptive_interface'])
+        if self._adaptive is None:
+            if link_counters is None:
+                log.warning('Unable to read the link counters, ignoring other traffic')
+            settings = self._get_profile_settings(self.level)
+            self._adaptive = {
+                'time': now,
+                'counters': counters,
+                'link_counters': link_counters,
+                'other': [0.0, 0.0],
+                'limits': [settings['max_download_speed'], settings['max_upload_speed']],
+            }
+            return
+
+        elapsed = now - self._adaptive['time']
+        if elapsed <= 0:
+            return
+
+        def get_rate(current, last):
+            # The counters restart from zero with the session or the interface
+            delta = current - last if current >= last else current
+            return delta / 1024.0 / elapsed
+
+        last_link_counters = self._adaptive['link_counters']
+        settings = {}
+        for i, (direction, setting) in enumerate(
+            [('down', 'download_rate_limit'), ('up', 'upload_rate_limit')]
+        ):
+            if link_counters is not None and last_link_counters is not None:
+                other = max(
+                    get_rate(link_counters[i], last_link_counters[i])
+                    - get_rate(counters[i], self._adaptive['counters'][i]),
+                    0.0,
+                )
+                other = (
+                    ADAPTIVE_SMOOTHING * other
+                    + (1 - ADAPTIVE_SMOOTHING) * self._adaptive['other'][i]
+                )
+                self._adaptive['other'][i] = other
+            else:
+                other = self._adaptive['other'][i]
+
+            link = self.config['adaptive_link_%s' % direction]
+            if link <= 0:
+                continue
+
+            # Bound by the adaptive maximum, or the link when unlimited
+            maximum = self.config['adaptive_max_%s' % direction]
+            if maximum <= 0:
+                maximum = link
+            minimum = min(self.config['adaptive_min_%s' % direction], maximum)
+
+            limit = self._adaptive['limits'][i]
+            if limit <= 0:
+                limit = maximum
+            target = link * self.config['adaptive_share'] / 100.0 - other
+            new_limit = limit + ADAPTIVE_GAIN * (target - limit)
+            new_limit = min(max(new_limit, minimum), maximum)
+            if abs(new_limit - limit) > ADAPTIVE_DEADBAND * limit:
+                self._adaptive['limits'][i] = new_limit
+                settings[setting] = int(new_limit * 1024)
+
+        self._adaptive['time'] = now
+        self._adaptive['counters'] = counters
+        self._adaptive['link_counters'] = link_counters
+
+        if settings:
+            log.debug('Adapting slow settings: %s', settings)
+            component.get('Core').apply_session_settings(settings)
+            self._applied_settings.update(settings)
+
     @export()
     def set_config(self, config):
         """Sets the config dictionary."""
-        for key in config:
-            self.config[key] = config[key]
-        self.config.save()
-        self.do_schedule(False)
+        if 'button_state' in config:
+            # Normalise rows so tuples and lists compare equal
+            config['button_state'] = [list(days) for days in config['button_state']]
+
+        changed = [
+            key
+            for key in config
+            if key not in self.config.config or self.config[key] != config[key]
+        ]
+        if not changed:
+            log.debug('Config unchanged, nothing to apply')
+            return
+
+        if 'profiles' in changed:
+            validate_profiles(config['profiles'])
+        if 'red_rank_key' in changed and config['red_rank_key'] not in RANK_KEYS:
+            raise ValueError('Invalid rank key %r' % config['red_rank_key'])
+        if 'button_state' in changed or 'profiles' in changed:
+            # Validate before touching the config
+            schedule = compile_schedule(
+                config.get('button_state', self.config['button_state']),
+                len(STATES) + len(config.get('profiles', self.config['profiles'])),
+            )
+
+        log.debug('Config keys changed: %s', changed)
+        for key in changed:
+            self.config.config[key] = config[key]
+        self.config_writer.save()
+
+        if 'button_state' in changed or 'profiles' in changed:
+            self.schedule = schedule
+            self.schedule_version += 1
+            log.debug('Compiled schedule version %s', self.schedule_version)
+
+        # Only a changed current level needs a full schedule run
+        if any(key in QUOTA_SETTINGS for key in changed):
+            self.quota_level = self._get_quota_level()
+        level_changed = (
+            'button_state' in changed
+            or 'ignore_schedule' in changed
+            or any(key in QUOTA_SETTINGS for key in changed)
+            # A Yellow quota compares the profiles with the Yellow settings
+            or (
+                self.quota_level == 1
+                and ('profiles' in changed or any(key in SLOW_SETTINGS for key in changed))
+            )
+        ) and self.get_level() != self.level
+        if 'force_use_individual' in changed and not self.config['force_use_individual']:
+            self._restore_torrent_limits()
+        if any(key in RANKING_SETTINGS for key in changed):
+            self._reset_ranking()
+        if 'adaptive_interface' in changed:
+            # The counters of another interface can't be compared
+            self._adaptive = None
+        if level_changed or 'force_use_individual' in changed:
+            self.do_schedule(False)
+        elif self.state == 'Red' and any(key in RANKING_SETTINGS for key in changed):
+            if self._use_ranking():
+                self._apply_ranking(True)
+            else:
+                self.do_schedule(False)
+        elif self.state == 'Yellow' and (
+            'adaptive_enabled' in changed
+            or 'yellow_exempt_forced' in changed
+            or (self.level == 1 and any(key in SLOW_SETTINGS for key in changed))
+            or (self.level >= len(STATES) and 'profiles' in changed)
+        ):
+            if 'adaptive_enabled' in changed:
+                # Restore the profile rates, or start adapting from them
+                self._applied_profile = None
+            self._apply_profile_settings(self.level)
+            if 'yellow_exempt_forced' in changed or self._exempt_forced():
+                # The per torrent shares may have changed
+                self._update_torrents()
 
     @export()
     def get_config(self):
         """Returns the config dictionary."""
         return self.config.config
 
+    @export()
+    def get_schedule(self):
+        """
+        Returns the compiled schedule.
+
+        :return: dict with the version, increased on every change, and the 168
+            levels indexed by hour * 7 + day
+        """
+        return {'version': self.schedule_version, 'levels': list(self.schedule)}
+
     @export()
     def get_state(self):
-        # Return 'green' state when schedule is ignored
+        return self._get_level_state(self.get_level())
+
+    @export()
+    def get_level(self):
+        """
+        Returns the current level, an index in the palette.
+        """
+        # Use 'green' level when schedule is ignored
         if self.config['ignore_schedule']:
-            return STATES[0]
+            level = 0
+        else:
+            # Get level from schedule
+            now = time.localtime(time.time())
+            level = self.schedule[now[3] * 7 + now[6]]
+
+        # The stricter of the schedule and quota level applies
+        if self.quota_level > LEVELS[self._get_level_state(level)]:
+            return self.quota_level
+        if (
+            self.quota_level == 1
+            and level >= len(STATES)
+            and not self._is_as_strict(level, 1)
+        ):
+            return 1
+        return level
 
-        # Get state from schedule
-        now = time.localtime(time.time())
-        level = self.config['button_state'][now[3]][now[6]]
-        return STATES[level]
+    @export()
+    def get_palette(self):
+        """
+        Returns the levels that can be used in the schedule.
+
+        :return: list of dicts with the name, colour and state of each level
+        """
+        return [
+            {
+                'name': self._get_profile(level)['name'],
+                'colour': self._get_profile(level).get('colour', STATE_COLOURS[1]),
+                'state': self._get_level_state(level),
+            }
+            for level in range(len(STATES) + len(self.config['profiles']))
+        ]
+
+    @export()
+    def get_quota(self):
+        """
+        Returns the transfer accounted in the current billing period.
+
+        :return: dict with the period start, the transferred bytes, the limit
+            in bytes and the quota state
+        """
+        return {
+            'period': self.quota['period'],
+            'bytes': self.quota['bytes'],
+            'limit': int(self.config['quota_limit'] * 1024 ** 3),
+            'state': STATES[self.quota_level],
+        }
+
+    @export()
+    def get_history(self, start=None, end=None):
+        """
+        Returns the recorded schedule transitions within a time range.
+
+        :param start: float, only return transitions at or after this timestamp
+        :param end: float, only return transitions before this timestamp
+        :return: list of dicts, oldest transition first
+        """
+
+        def get_name(level):
+            # Older entries hold the level instead of its name
+            if isinstance(level, int):
+                return self._get_profile_name(level)
+            return level
+
+        return [
+            {
+                'time': t,
+                'from': get_name(from_level),
+                'to': get_name(to_level),
+                'torrents': torrents,
+                'duration': duration / 1000.0,
+            }
+            for t, from_level, to_level, torrents, duration in self.history
+            if (start is None or t >= start) and (end is None or t < end)
+        ]
 
     @export()
     def get_forced(self, torrent_ids):
-        if not hasattr(torrent_ids, '__iter__'):
+        if isinstance(torrent_ids, (bytes, type(''))):
             torrent_ids = [torrent_ids]
 
         def f(t_id):
@@ -240,32 +948,226 @@ class Core(CorePluginBase):
 
     @export()
     def set_forced(self, torrent_ids, forced=True):
-        log.debug('Setting torrent %s to forced=%s' % (torrent_ids, forced))
+        """
+        Set the forced flag for a batch of torrents.
+
+        The torrents are paused or resumed cooperatively so large selections
+        don't block the daemon.
 
-        if not hasattr(torrent_ids, '__iter__'):
+        :return: Deferred firing a dict of torrent_id -> bool, False for unknown ids
+        """
+        # A single id, str and unicode on Python 2 are both iterable
+        if isinstance(torrent_ids, (bytes, type(''))):
             torrent_ids = [torrent_ids]
 
+        log.debug('Setting %s torrents to forced=%s' % (len(torrent_ids), forced))
+
+        torrents = component.get('Core').torrentmanager.torrents
+        results = {}
         for t in torrent_ids:
-            self.torrent_states[t]['forced'] = forced
+            if t not in torrents:
+                results[t] = False
+                continue
+            try:
+                tstate = self.torrent_states[t]
+            except KeyError:
+                tstate = {'forced': False, 'paused': False}
+                self.torrent_states.config[t] = tstate
+            tstate['forced'] = forced
+            results[t] = True
+            # Re-rank first so an unforced torrent kept in Red isn't paused
+            if self.ranking is not None:
+                self._rank_torrent(t, torrents[t])
+
+        def update_torrents():
+            for t, valid in results.items():
+                # Skip torrents removed in the meantime
+                if valid and t in torrents:
+                    self._update_torrent(t, save_state=False)
+                    yield None
+
+        def on_updated(result):
+            # Apply the torrents displaced from the ranking by the batch
+            if self.state == 'Red' and self._use_ranking():
+                self._apply_ranking(False)
+            # Save all states at once
+            self.states_writer.save()
+            return results
+
+        return task.cooperate(update_torrents()).whenDone().addCallback(on_updated)
+
+    def _get_level_state(self, level):
+        """
+        Returns the state of a level, profiles are Yellow (Slow) states.
+        """
+        return STATES.get(level, STATES[1])
+
+    def _get_profile(self, level):
+        """
+        Returns the profile of a level, built-in levels use the low_* prefs.
+        """
+        if level == 1:
+            return {
+                'name': STATES[1],
+                'colour': STATE_COLOURS[1],
+                'max_download_speed': self.config['low_down'],
+                'max_upload_speed': self.config['low_up'],
+                'max_active_limit': self.config['low_active'],
+                'max_active_downloading': self.config['low_active_down'],
+                'max_active_seeding': self.config['low_active_up'],
+            }
+        elif level in STATES:
+            return {'name': STATES[level], 'colour': STATE_COLOURS[level]}
+        return self.config['profiles'][level - len(STATES)]
+
+    def _is_as_strict(self, level, other_level):
+        """
+        Returns whether every limit of a Yellow level is at most the limit of
+        another Yellow level.
+        """
+        def limit(value):
+            return float('inf') if value < 0 else value
+
+        settings = self._get_profile_settings(level)
+        other_settings = self._get_profile_settings(other_level)
+        return all(
+            limit(settings[setting]) <= limit(other_settings[setting])
+            for setting in CONTROLLED_SETTINGS
+        )
+
+    def _get_profile_name(self, level):
+        """
+        Returns the name of a level, also for profiles removed since.
+        """
+        try:
+            return self._get_profile(level)['name']
+        except IndexError:
+            return 'Profile %s' % level
+
+    @export()
+    def get_compact_report(self):
+        """
+        Returns the result of the last completed torrent states compaction.
+
+        :return: dict with the completion time, the number of states scanned
+            and the number of stale states reclaimed
+        """
+        return self.compact_report
+
+    def _get_session_counters(self):
+        """
+        Returns the session (received, sent) byte counters.
+        """
+        status = component.get('Core').get_session_status(SESSION_COUNTERS)
+        return [status[key] for key in SESSION_COUNTERS]
+
+    def _get_quota_period(self):
+        """
+        Returns the start date of the current billing period as 'YYYY-MM-DD'.
+        """
+        # Clamp so every month has the reset day
+        reset_day = min(max(int(self.config['quota_reset_day']), 1), 28)
+        today = datetime.date.today()
+        if today.day >= reset_day:
+            return today.replace(day=reset_day).isoformat()
+        if today.month == 1:
+            return today.replace(year=today.year - 1, month=12, day=reset_day).isoformat()
+        return today.replace(month=today.month - 1, day=reset_day).isoformat()
+
+    def _get_quota_level(self):
+        """
+        Returns the schedule level enforced by the quota.
+        """
+        if not self.config['quota_enabled'] or self.config['quota_limit'] <= 0:
+            return 0
+        if self.quota['period'] != self._get_quota_period():
+            # Nothing was transferred yet in this billing period
+            return 0
+
+        used = 100.0 * self.quota['bytes'] / (self.config['quota_limit'] * 1024 ** 3)
+        if used >= self.config['quota_red']:
+            return 2
+        elif used >= self.config['quota_yellow']:
+            return 1
+        return 0
+
+    def _sample_quota(self):
+        """
+        Account the session transfer since the last sample against the quota.
+        """
+        if not self.config['quota_enabled']:
+            self._quota_last = None
+            return
 
-        self._update_torrents(torrent_ids)
+        total = sum(self._get_session_counters())
+
+        if self._quota_last is not None:
+            # The counters restart from zero with the session
+            delta = total - self._quota_last if total >= self._quota_last else total
+            period = self._get_quota_period()
+            if self.quota['period'] != period:
+                log.info('Starting new quota period %s', period)
+                self.quota.config['period'] = period
+                self.quota.config['bytes'] = 0
+                self.quota_writer.save()
+            if delta:
+                self.quota.config['bytes'] += delta
+                self.quota_writer.save()
+        self._quota_last = total
+
+        level = self._get_quota_level()
+        if level != self.quota_level:
+            log.info('Quota level changed to %s', STATES[level])
+            self.quota_level = level
+            if self.get_level() != self.level:
+                self.do_schedule(False)
+
+    def _record_transition(self, from_level, to_level, torrents, duration):
+        """
+        Append a transition to the history ring buffer and persist it.
+        """
+        # Names are stored as the profiles may be reordered or removed later
+        from_name = self._get_profile_name(from_level)
+        to_name = self._get_profile_name(to_level)
+        log.debug(
+            'Transition %s -> %s touched %s torrents in %.3f seconds',
+            from_name,
+            to_name,
+            torrents,
+            duration,
+        )
+        self.history.append(
+            [
+                int(time.time()),
+                from_name,
+                to_name,
+                torrents,
+                int(duration * 1000),
+            ]
+        )
+        self.history_config.config['transitions'] = list(self.history)
+        self.history_writer.save()
 
     def _pause_all_torrents(self):
         """
         Pause all torrents in the session.
         Fix for https://github.com/h3llrais3r/deluge-myscheduler/issues/4
         """
-        for torrent in component.get('Core').torrentmanager.torrents.values():
+        torrents = component.get('Core').torrentmanager.torrents.values()
+        for torrent in torrents:
             torrent.pause()
+        return len(torrents)
 
     def _resume_all_torrents(self):
         """
         Resume all torrents in the session.
         Fix for https://github.com/h3llrais3r/deluge-myscheduler/issues/4
         """
-        for torrent in component.get('Core').torrentmanager.torrents.values():
+        torrents = component.get('Core').torrentmanager.torrents.values()
+        for torrent in torrents:
             torrent.resume()
         component.get('EventManager').emit(SessionResumedEvent())
+        return len(torrents)
 
     def _update_torrents(self, torrent_ids=None):
         if not self.config['force_use_individual']:
@@ -273,51 +1175,128 @@ class Core(CorePluginBase):
 
         if not torrent_ids:
             torrent_ids = component.get('Core').torrentmanager.get_torrent_list()
-        elif not hasattr(torrent_ids, '__iter__'):
+        elif isinstance(torrent_ids, (bytes, type(''))):
             torrent_ids = [torrent_ids]
 
         for torrent_id in torrent_ids:
             self._update_torrent(torrent_id, save_state=False)
 
         # Save all states at once
-        self.torrent_states.save()
+        self.states_writer.save()
 
     def _update_torrent(self, torrent_id, save_state=True):
         if not self.config['force_use_individual']:
             return
 
-        torrent = component.get('Core').torrentmanager.torrents[torrent_id]
+        try:
+            torrent = component.get('Core').torrentmanager.torrents[torrent_id]
+        except KeyError:
+            # The torrent has been removed in the meantime
+            return
+
         try:
             tstate = self.torrent_states[torrent_id]
         except KeyError:
             tstate = {'forced': False, 'paused': False}
-            self.torrent_states[torrent_id] = tstate
+            self.torrent_states.config[torrent_id] = tstate
+
+        self._set_torrent_limits(torrent, tstate)
 
         if self.state == 'Green' or self.state == 'Yellow':
             if tstate['paused']:
                 torrent.resume()
                 tstate['paused'] = False
         elif self.state == 'Red':
+            # Torrents selected by the ranking keep running like forced ones
+            kept = self._use_ranking() and torrent_id in self.ranking.selected
             # checking that state != paused is to make sure that we don't
             # set our paused flag on something that the user has paused previously
-            if not tstate['forced'] and torrent.state != 'Paused':
+            if not tstate['forced'] and not kept and torrent.state != 'Paused':
                 torrent.pause()
                 tstate['paused'] = True
-            elif tstate['forced']:
+            elif tstate['forced'] or kept:
                 torrent.resume()
                 tstate['paused'] = False
 
         if save_state:
-            self.torrent_states.save()
+            self.states_writer.save()
+
+    def _use_ranking(self):
+        return self.ranking is not None and self.config['force_use_individual']
+
+    def _reset_ranking(self):
+        """
+        Rebuild the ranking of the torrents to keep running in Red.
+        """
+        if self.config['red_keep_running'] <= 0:
+            self.ranking = None
+            return
+
+        self.ranking = TorrentRanking(
+            self.config['red_rank_key'], self.config['red_keep_running']
+        )
+        for torrent_id, torrent in component.get('Core').torrentmanager.torrents.items():
+            self._rank_torrent(torrent_id, torrent)
+
+    def _rank_torrent(self, torrent_id, torrent):
+        """
+        Update the score of a torrent, forced torrents run anyway so aren't ranked.
+        """
+        try:
+            forced = self.torrent_states[torrent_id]['forced']
+        except KeyError:
+            forced = False
+
+        if forced:
+            self.ranking.discard(torrent_id)
+        else:
+            self.ranking.update(torrent_id, torrent)
+
+    def _apply_ranking(self, full=False):
+        """
+        Pause and resume the torrents whose membership in the ranking changed.
+
+        :param full: bool, update all torrents, e.g. when entering Red
+        :return: int, the number of torrents updated
+        """
+        added, dropped = self.ranking.pop_changes()
+        if full:
+            torrent_ids = component.get('Core').torrentmanager.get_torrent_list()
+        else:
+            torrent_ids = added | dropped
+
+        for torrent_id in torrent_ids:
+            self._update_torrent(torrent_id, save_state=False)
+        if torrent_ids:
+            self.states_writer.save()
+        return len(torrent_ids)
+
+    def _on_torrent_event(self, torrent_id):
+        """
+        Re-rank a torrent after an event and apply a changed selection in Red.
+        """
+        if self.ranking is None:
+            return
+
+        torrent = component.get('Core').torrentmanager.torrents.get(torrent_id)
+        if torrent is None:
+            self.ranking.discard(torrent_id)
+        else:
+            self._rank_torrent(torrent_id, torrent)
+        if self.state == 'Red' and self._use_ranking():
+            self._apply_ranking(False)
 
     def _on_torrent_added(self, torrent_id, from_state):
+        self._on_torrent_event(torrent_id)
         self._update_torrent(torrent_id)
 
     def _on_torrent_resumed(self, torrent_id):
+        self._on_torrent_event(torrent_id)
         self._update_torrent(torrent_id)
 
     def _on_torrent_removed(self, torrent_id):
-        self._update_torrent(torrent_id)
+        self._remove_torrent([torrent_id])
+        self._on_torrent_event(torrent_id)
 
     def _on_torrent_finished(self, torrent_id):
         if self.config['force_unforce_finished']:
@@ -330,6 +1309,32 @@ class Core(CorePluginBase):
                     tstate['forced'] = False
                     tstate['paused'] = False
                     self._update_torrent(torrent_id)
+        self._on_torrent_event(torrent_id)
+
+    def _rescore_torrents(self):
+        """
+        Refresh the scores of the ranked torrents, a bounded batch per pass.
+
+        Scores drift as torrents transfer, a sweep walks a snapshot of the torrent
+        ids over as many passes as needed and then starts over.
+        """
+        if self.ranking is None:
+            self._rank_sweep = None
+            return
+
+        torrents = component.get('Core').torrentmanager.torrents
+        if self._rank_sweep is None:
+            self._rank_sweep = iter(list(torrents))
+
+        batch = list(itertools.islice(self._rank_sweep, RANK_BATCH))
+        if len(batch) < RANK_BATCH:
+            self._rank_sweep = None
+        for torrent_id in batch:
+            if torrent_id in torrents:
+                self._rank_torrent(torrent_id, torrents[torrent_id])
+
+        if self.state == 'Red' and self._use_ranking():
+            self._apply_ranking(False)
 
     def _cleanup_states(self):
         valid = set(component.get('Core').torrentmanager.get_torrent_list())
@@ -337,23 +1342,55 @@ class Core(CorePluginBase):
 
         self._remove_torrent(saved - valid)
 
+    def _compact_states(self):
+        """
+        Reclaim the states of removed torrents, a bounded batch per pass.
+
+        A sweep walks a snapshot of the state ids over as many passes as needed
+        and reports the result once it completes.
+        """
+        if self._compact_sweep is None:
+            self._compact_sweep = {
+                'ids': iter(list(self.torrent_states.config)),
+                'scanned': 0,
+                'reclaimed': 0,
+            }
+        sweep = self._compact_sweep
+
+        torrents = component.get('Core').torrentmanager.torrents
+        batch = list(itertools.islice(sweep['ids'], COMPACT_BATCH))
+        sweep['scanned'] += len(batch)
+        sweep['reclaimed'] += self._remove_torrent(
+            [torrent_id for torrent_id in batch if torrent_id not in torrents]
+        )
+
+        if len(batch) < COMPACT_BATCH:
+            self._compact_sweep = None
+            self.compact_report = {
+                'time': time.time(),
+                'scanned': sweep['scanned'],
+                'reclaimed': sweep['reclaimed'],
+            }
+            log.debug(
+                'Compacted torrent states: reclaimed %s of %s',
+                sweep['reclaimed'],
+                sweep['scanned'],
+            )
+
     def _remove_torrent(self, torrent_ids):
-        do_save = False
+        removed = 0
 
-        if not hasattr(torrent_ids, '__iter__'):
+        if isinstance(torrent_ids, (bytes, type(''))):
             torrent_ids = [torrent_ids]
 
         for torrent_id in torrent_ids:
             try:
-                try:
-                    del self.torrent_states[torrent_id]
-                except AttributeError:
-                    # old config's didn't have a __delitem__
-                    # new config's do and do a .save() automatically
-                    del self.torrent_states.config[torrent_id]
-                    do_save = True
+                # Bypass the config's __delitem__ which schedules a blocking save
+                del self.torrent_states.config[torrent_id]
+                removed += 1
             except KeyError:
                 pass
 
-        if do_save:
-            self.torrent_states.save()
+        if removed:
+            self.states_writer.save()
+        return removed
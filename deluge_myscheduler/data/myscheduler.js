@@ -89,27 +89,7 @@ Deluge.ux.ScheduleSelector = Ext.extend(Ext.form.FieldSet, {
         }
         el2.style[floatAttr] = 'right';
 
-        for (var i = 0; i < this.states.length; i++) {
-            var el3 = createEl(el2, 'input');
-            el3.type = 'radio';
-            el3.value = this.states[i].value;
-            el3.name = this.stateBrushName;
-            el3.id = this.stateBrushName + '-' + this.states[i].name;
-
-            // isn't the first one
-            if (i > 0) el3.style.marginLeft = '7px';
-
-            // assume the first is the default state, so make the 2nd one the default brush
-            if (i == 1) el3.checked = true;
-
-            var el4 = createEl(el2, 'label');
-            el4.appendChild(document.createTextNode(this.states[i].name));
-            el4.htmlFor = el3.id;
-            el4.style.backgroundColor = this.states[i].backgroundColor;
-            el4.style.borderBottom = '2px solid ' + this.states[i].borderColor;
-            el4.style.padding = '2px 3px';
-            el4.style.marginLeft = '3px';
-        }
+        this.renderStateBrushes();
 
         el1.appendChild(document.createTextNode('Select a state brush:'));
 
@@ -175,6 +155,71 @@ Deluge.ux.ScheduleSelector = Ext.extend(Ext.form.FieldSet, {
         );
     },
 
+    renderStateBrushes: function() {
+        var el2 = this.stateBrush;
+
+        function createEl(parent, type) {
+            var el = document.createElement(type);
+            parent.appendChild(el);
+            return el;
+        }
+
+        // remove all existing brushes
+        while (el2.childNodes.length > 0) {
+            el2.removeChild(el2.firstChild);
+        }
+
+        for (var i = 0; i < this.states.length; i++) {
+            var el3 = createEl(el2, 'input');
+            el3.type = 'radio';
+            el3.value = this.states[i].value;
+            el3.name = this.stateBrushName;
+            el3.id = this.stateBrushName + '-' + this.states[i].value;
+
+            // isn't the first one
+            if (i > 0) el3.style.marginLeft = '7px';
+
+            // assume the first is the default state, so make the 2nd one the default brush
+            if (i == 1) el3.checked = true;
+
+            var el4 = createEl(el2, 'label');
+            el4.appendChild(document.createTextNode(this.states[i].name));
+            el4.htmlFor = el3.id;
+            el4.style.backgroundColor = this.states[i].backgroundColor;
+            el4.style.borderBottom = '2px solid ' + this.states[i].borderColor;
+            el4.style.padding = '2px 3px';
+            el4.style.marginLeft = '3px';
+        }
+    },
+
+    setPalette: function(palette) {
+        // keep the built-in states, add a state for every named profile
+        var states = this.states.slice(0, 3);
+
+        for (var i = states.length; i < palette.length; i++) {
+            states.push({
+                name: palette[i].name,
+                backgroundColor: palette[i].colour,
+                borderColor: palette[i].colour,
+                value: i
+            });
+        }
+        this.states = states;
+
+        if (this.stateBrush) this.renderStateBrushes();
+
+        // recolour the cells, their levels may have been set before the palette
+        if (this.scheduleCells) {
+            Ext.each(
+                this.daysOfWeek,
+                function(day) {
+                    Ext.each(this.scheduleCells[day], this.updateCell, this);
+                },
+                this
+            );
+        }
+    },
+
     updateCell: function(cell) {
         // sanity check
         if (cell.currentValue == undefined) return;
@@ -650,6 +695,16 @@ Deluge.ux.preferences.MySchedulerPage = Ext.extend(Ext.Panel, {
     },
 
     updateConfig: function() {
+        deluge.client.myscheduler.get_palette({
+            success: function(palette) {
+                this.schedule.setPalette(palette);
+                this.loadConfig();
+            },
+            scope: this
+        });
+    },
+
+    loadConfig: function() {
         deluge.client.myscheduler.get_config({
             success: function(config) {
                 this.schedule.setConfig(config['button_state']);
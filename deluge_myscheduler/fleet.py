@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Deluge and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+Command-line controller applying a MyScheduler config to many daemons.
+
+The schedule file is a JSON dict with any of the MyScheduler prefs, for example
+'button_state' and the 'low_*' limits. Each daemon's current config is fetched
+first and only the differing keys are set.
+
+Usage: myscheduler-fleet schedule.json [user[:password]@]host[:port] ...
+
+IPv6 addresses are given as [address]:port.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from twisted.internet import defer, task
+
+import deluge.configmanager
+from deluge.common import get_localhost_auth
+from deluge.ui.client import Client
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 58846
+
+
+def parse_host(spec):
+    """
+    Parse a '[user[:password]@]host[:port]' daemon spec.
+
+    Without a user the client uses the localclient credentials for local daemons,
+    it only recognises the IPv4 local addresses so they are looked up for ::1.
+
+    :return: tuple, (host, port, username, password)
+    """
+    username = password = ''
+    if '@' in spec:
+        credentials, spec = spec.rsplit('@', 1)
+        username, _, password = credentials.partition(':')
+
+    if spec.startswith('['):
+        # [address]:port
+        host, _, port = spec[1:].partition(']')
+        port = port.lstrip(':')
+    elif spec.count(':') > 1:
+        # Bare IPv6 address
+        host, port = spec, ''
+    else:
+        host, _, port = spec.partition(':')
+    port = int(port) if port else DEFAULT_PORT
+
+    if not username and host == '::1':
+        username, password = get_localhost_auth()
+
+    return host, port, username, password
+
+
+def normalise(value):
+    """
+    Convert the tuples returned over RPC to lists so values compare equal.
+    """
+    if isinstance(value, (list, tuple)):
+        return [normalise(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: normalise(v) for k, v in value.items()}
+    return value
+
+
+@defer.inlineCallbacks
+def apply_schedule(spec, schedule, dry_run=False):
+    """
+    Apply the schedule to one daemon.
+
+    :return: Deferred firing a result dict for the report
+    """
+    host, port, username, password = parse_host(spec)
+    client = Client()
+    start = time.time()
+
+    yield client.connect(host, port, username, password)
+    connected = time.time()
+    try:
+        config = normalise((yield client.myscheduler.get_config()))
+        changed = {
+            key: value
+            for key, value in schedule.items()
+            if key not in config or config[key] != value
+        }
+        if changed and not dry_run:
+            yield client.myscheduler.set_config(changed)
+        state = yield client.myscheduler.get_state()
+    finally:
+        yield client.disconnect()
+
+    defer.returnValue(
+        {
+            'host': spec,
+            'changed': sorted(changed),
+            'state': state,
+            'connect': connected - start,
+            'total': time.time() - start,
+        }
+    )
+
+
+def print_report(specs, results, dry_run=False):
+    """
+    Print one line per daemon and return the number of failed daemons.
+    """
+    failed = 0
+    for spec, (success, result) in zip(specs, results):
+        if not success:
+            failed += 1
+            print('%s\terror\t%s' % (spec, result.getErrorMessage()))
+            continue
+
+        if not result['changed']:
+            status = 'unchanged'
+        else:
+            status = '%s %s' % (
+                'would set' if dry_run else 'set',
+                ','.join(result['changed']),
+            )
+        print(
+            '%s\t%s\t%s\tconnect %.0f ms\ttotal %.0f ms'
+            % (
+                spec,
+                result['state'],
+                status,
+                result['connect'] * 1000,
+                result['total'] * 1000,
+            )
+        )
+    return failed
+
+
+@defer.inlineCallbacks
+def run(reactor, options):
+    with open(options.schedule) as _file:
+        schedule = normalise(json.load(_file))
+
+    specs = list(options.hosts)
+    if options.hosts_file:
+        with open(options.hosts_file) as _file:
+            specs.extend(line.strip() for line in _file if line.strip())
+
+    # Limit the number of concurrent daemon connections
+    pool = defer.DeferredSemaphore(options.jobs)
+    results = yield defer.DeferredList(
+        [
+            pool.run(apply_schedule, spec, schedule, options.dry_run)
+            for spec in specs
+        ],
+        consumeErrors=True,
+    )
+
+    if print_report(specs, results, options.dry_run):
+        raise SystemExit(1)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Apply a MyScheduler schedule file to many deluge daemons'
+    )
+    parser.add_argument('schedule', help='JSON file with the MyScheduler prefs to set')
+    parser.add_argument(
+        'hosts', nargs='*', help='daemons as [user[:password]@]host[:port]'
+    )
+    parser.add_argument('-f', '--hosts-file', help='file with one daemon per line')
+    parser.add_argument(
+        '-c', '--config', help='deluge config dir holding the localclient auth'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=10, help='concurrent daemon connections'
+    )
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true', help='only report the differences'
+    )
+    options = parser.parse_args(args)
+
+    if not options.hosts and not options.hosts_file:
+        parser.error('no daemons given')
+
+    if options.config:
+        deluge.configmanager.set_config_dir(options.config)
+
+    logging.basicConfig(level=logging.WARNING)
+    task.react(run, [options])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
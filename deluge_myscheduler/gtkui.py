@@ -49,6 +49,7 @@ class MySchedulerSelectWidget(Gtk.DrawingArea):
             [237 / 255, 212 / 255, 0 / 255],
             [204 / 255, 0 / 255, 0 / 255],
         ]
+        self.names = ['Green', 'Yellow', 'Red']
         self.button_state = [[0] * 7 for dummy in range(24)]
 
         self.start_point = [0, 0]
@@ -58,6 +59,16 @@ class MySchedulerSelectWidget(Gtk.DrawingArea):
         self.mouse_press = False
         self.set_size_request(350, 150)
 
+    def set_palette(self, palette):
+        self.colors = []
+        self.names = []
+        for level in palette:
+            rgba = Gdk.RGBA()
+            rgba.parse(level['colour'])
+            self.colors.append([rgba.red, rgba.green, rgba.blue])
+            self.names.append(level['name'])
+        self.queue_draw()
+
     def set_button_state(self, state):
         self.button_state = []
         for s in state:
@@ -122,12 +133,12 @@ class MySchedulerSelectWidget(Gtk.DrawingArea):
         if end_point[0] is self.start_point[0] and end_point[1] is self.start_point[1]:
             if event.button == 1:
                 self.button_state[end_point[0]][end_point[1]] += 1
-                if self.button_state[end_point[0]][end_point[1]] > 2:
+                if self.button_state[end_point[0]][end_point[1]] > len(self.colors) - 1:
                     self.button_state[end_point[0]][end_point[1]] = 0
             elif event.button == 3:
                 self.button_state[end_point[0]][end_point[1]] -= 1
                 if self.button_state[end_point[0]][end_point[1]] < 0:
-                    self.button_state[end_point[0]][end_point[1]] = 2
+                    self.button_state[end_point[0]][end_point[1]] = len(self.colors) - 1
             self.queue_draw()
 
     # if box changed and mouse is pressed draw all boxes from start point to end point
@@ -142,7 +153,9 @@ class MySchedulerSelectWidget(Gtk.DrawingArea):
                 + str(self.hover_point[0])
                 + ':00 - '
                 + str(self.hover_point[0])
-                + ':59'
+                + ':59 ('
+                + self.names[self.button_state[self.hover_point[0]][self.hover_point[1]]]
+                + ')'
             )
 
             if self.mouse_press:
@@ -239,6 +252,10 @@ class GtkUI(Gtk3PluginBase):
         client.myscheduler.set_config(config)
 
     def on_show_prefs(self):
+        def on_get_palette(palette):
+            log.debug('Palette: %s', palette)
+            self.scheduler_select.set_palette(palette)
+
         def on_get_config(config):
             log.debug('Config: %s', config)
             self.scheduler_select.set_button_state(config['button_state'])
@@ -251,6 +268,7 @@ class GtkUI(Gtk3PluginBase):
             self.check_individual_scheduling.set_active(config['force_use_individual'])
             self.check_unforce_finished.set_active(config['force_unforce_finished'])
 
+        client.myscheduler.get_palette().addCallback(on_get_palette)
         client.myscheduler.get_config().addCallback(on_get_config)
 
     def on_scheduler_event(self, state):
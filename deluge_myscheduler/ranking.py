@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Deluge and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+from __future__ import unicode_literals
+
+import heapq
+
+# Score of torrents that should only be kept when nothing else is left
+LOWEST = float('-inf')
+
+
+def ratio_deficit(torrent):
+    """Torrents furthest below their stop ratio rank first."""
+    ratio = torrent.get_ratio()
+    if ratio < 0:
+        # Nothing downloaded yet, so nothing to seed
+        return LOWEST
+    return torrent.options['stop_ratio'] - ratio
+
+
+def peer_demand(torrent):
+    """Torrents with the most peers in the swarm rank first."""
+    return torrent.get_status(['total_peers'])['total_peers']
+
+
+def queue_position(torrent):
+    """Torrents at the top of the queue rank first, unqueued torrents last."""
+    position = torrent.get_queue_position()
+    if position < 0:
+        # Seeding and finished torrents aren't queued
+        return LOWEST
+    return -position
+
+
+RANK_KEYS = {
+    'ratio_deficit': ratio_deficit,
+    'peer_demand': peer_demand,
+    'queue_position': queue_position,
+}
+
+
+class TorrentRanking(object):
+    """
+    Keeps the best torrents by a score.
+
+    The selected torrents are kept in a min-heap and the other candidates in a
+    max-heap, so updating the score of one torrent costs O(log n). Heap entries
+    are invalidated lazily when a score or the selection changes.
+    """
+
+    def __init__(self, rank_key, size):
+        """
+        :param rank_key: str, one of RANK_KEYS
+        :param size: int, the number of torrents to select
+        """
+        self.score = RANK_KEYS[rank_key]
+        self.size = size
+        self.scores = {}
+        self.selected = set()
+        # (score, torrent_id) with the worst selected torrent on top
+        self._selected_heap = []
+        # (-score, torrent_id) with the best candidate on top
+        self._candidate_heap = []
+        self._added = set()
+        self._dropped = set()
+
+    def update(self, torrent_id, torrent):
+        score = self.score(torrent)
+        if torrent_id in self.scores and self.scores[torrent_id] == score:
+            return
+
+        self.scores[torrent_id] = score
+        if torrent_id in self.selected:
+            heapq.heappush(self._selected_heap, (score, torrent_id))
+        else:
+            heapq.heappush(self._candidate_heap, (-score, torrent_id))
+        self._rebalance()
+
+    def discard(self, torrent_id):
+        if torrent_id not in self.scores:
+            return
+
+        del self.scores[torrent_id]
+        if torrent_id in self.selected:
+            self.selected.remove(torrent_id)
+            self._record_dropped(torrent_id)
+            self._rebalance()
+
+    def pop_changes(self):
+        """
+        Returns the changes of the selection since the last call.
+
+        :return: tuple of sets, the torrent ids added to and dropped from the selection
+        """
+        added, dropped = self._added, self._dropped
+        self._added, self._dropped = set(), set()
+        return added, dropped
+
+    def _worst_selected(self):
+        heap = self._selected_heap
+        while heap:
+            score, torrent_id = heap[0]
+            if torrent_id in self.selected and self.scores[torrent_id] == score:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def _best_candidate(self):
+        heap = self._candidate_heap
+        while heap:
+            score, torrent_id = heap[0]
+            if (
+                torrent_id in self.scores
+                and torrent_id not in self.selected
+                and self.scores[torrent_id] == -score
+            ):
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def _rebalance(self):
+        while True:
+            if len(self.selected) > self.size:
+                self._worst_selected()
+                self._deselect(heapq.heappop(self._selected_heap)[1])
+                continue
+
+            best = self._best_candidate()
+            if best is None:
+                break
+            if len(self.selected) < self.size:
+                heapq.heappop(self._candidate_heap)
+                self._select(best[1])
+                continue
+
+            worst = self._worst_selected()
+            if worst is None or -best[0] <= worst[0]:
+                break
+            heapq.heappop(self._candidate_heap)
+            heapq.heappop(self._selected_heap)
+            self._deselect(worst[1])
+            self._select(best[1])
+
+        # Drop the invalidated entries once they outnumber the valid ones
+        if len(self._selected_heap) + len(self._candidate_heap) > 2 * len(self.scores) + 64:
+            self._selected_heap = [(self.scores[t], t) for t in self.selected]
+            self._candidate_heap = [
+                (-score, t) for t, score in self.scores.items() if t not in self.selected
+            ]
+            heapq.heapify(self._selected_heap)
+            heapq.heapify(self._candidate_heap)
+
+    def _select(self, torrent_id):
+        self.selected.add(torrent_id)
+        heapq.heappush(self._selected_heap, (self.scores[torrent_id], torrent_id))
+        if torrent_id in self._dropped:
+            self._dropped.remove(torrent_id)
+        else:
+            self._added.add(torrent_id)
+
+    def _deselect(self, torrent_id):
+        self.selected.remove(torrent_id)
+        heapq.heappush(self._candidate_heap, (-self.scores[torrent_id], torrent_id))
+        self._record_dropped(torrent_id)
+
+    def _record_dropped(self, torrent_id):
+        if torrent_id in self._added:
+            self._added.remove(torrent_id)
+        else:
+            self._dropped.add(torrent_id)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Deluge and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+from __future__ import unicode_literals
+
+import copy
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from twisted.internet import threads
+
+try:
+    from os import replace as replace_file
+except ImportError:
+    # Python 2, like deluge.config.Config
+    from shutil import move as replace_file
+
+log = logging.getLogger(__name__)
+
+
+def write_config(filename, version, data):
+    """
+    Atomically write config data in the deluge config file format.
+
+    The data is written and fsynced to a temporary file in the same directory,
+    which is then renamed over the config file.
+
+    :param filename: str, the config file path
+    :param version: dict, the config version header
+    :param data: dict, the config data
+    """
+    fd, tmp_filename = tempfile.mkstemp(
+        prefix=os.path.basename(filename) + '.', suffix='.new',
+        dir=os.path.dirname(filename)
+    )
+    try:
+        with os.fdopen(fd, 'w') as _file:
+            _file.write(json.dumps(version))
+            _file.write(json.dumps(data, sort_keys=True))
+            _file.flush()
+            os.fsync(_file.fileno())
+        replace_file(tmp_filename, filename)
+    except Exception:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+class ConfigWriter(object):
+    """
+    Saves a deluge Config without blocking the reactor.
+
+    A snapshot of the config is taken in the reactor thread, the serialising
+    and writing happens in a worker thread. At most one write is in flight,
+    saves requested meanwhile only mark the config dirty and a single snapshot
+    is taken once the write finishes.
+    """
+
+    def __init__(self, config, version):
+        """
+        :param config: deluge.config.Config, the config to save
+        :param version: dict, the version header written in front of the data
+        """
+        self.config = config
+        self.version = version
+        self._writing = False
+        self._dirty = False
+        # Snapshots are numbered so an older write never replaces a newer one
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._written = 0
+
+    def save(self):
+        # The save supersedes a delayed save scheduled by the config itself
+        save_timer = getattr(self.config, '_save_timer', None)
+        if save_timer is not None and save_timer.active():
+            save_timer.cancel()
+
+        if self._writing:
+            self._dirty = True
+        else:
+            self._write()
+
+    def flush(self):
+        """
+        Write the dirty config in the calling thread, e.g. when disabling.
+
+        A write still in flight cannot replace it afterwards.
+        """
+        if self._dirty:
+            self._dirty = False
+            try:
+                self._write_snapshot(self._snapshot())
+            except Exception as ex:
+                log.error('Unable to save %s: %s', self.config.config_file, ex)
+
+    def _snapshot(self):
+        self._sequence += 1
+        return self._sequence, copy.deepcopy(self.config.config)
+
+    def _write(self):
+        self._writing = True
+        d = threads.deferToThread(self._write_snapshot, self._snapshot())
+        d.addErrback(self._on_write_error)
+        d.addBoth(self._on_written)
+
+    def _write_snapshot(self, pending):
+        sequence, snapshot = pending
+        with self._lock:
+            if sequence > self._written:
+                write_config(self.config.config_file, self.version, snapshot)
+                self._written = sequence
+
+    def _on_write_error(self, failure):
+        log.error(
+            'Unable to save %s: %s', self.config.config_file, failure.getErrorMessage()
+        )
+
+    def _on_written(self, result):
+        self._writing = False
+        if self._dirty:
+            self._dirty = False
+            self._write()
@@ -41,6 +41,8 @@ setup(
     %s = deluge_%s:GtkUIPlugin
     [deluge.plugin.web]
     %s = deluge_%s:WebUIPlugin
+    [console_scripts]
+    myscheduler-fleet = deluge_myscheduler.fleet:main
     """
     % ((__plugin_name__, __plugin_name__.lower()) * 3),
 )